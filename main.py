@@ -1,8 +1,22 @@
+import io
 import os
+import json
+import time
+import base64
+import hashlib
 import tempfile
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+import orjson
 from flask import Flask, request, abort
 import telegram
+from telegram.utils.request import Request
+import openai
 from openai import OpenAI   # ✅ Nuevo import de la API moderna
 from gtts import gTTS
 
@@ -10,63 +24,590 @@ from gtts import gTTS
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # opcional
+LOG_CHAT_ID = os.environ.get("LOG_CHAT_ID")  # opcional, chat donde se publica la ayuda una vez
+REDIS_URL = os.environ.get("REDIS_URL")  # opcional, caché compartida entre workers
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 3600))
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "bot_tts_cache")
+TTS_CACHE_MAX_FILES = int(os.environ.get("TTS_CACHE_MAX_FILES", 500))
+# Caché semántica (opcional): se activa dando un umbral de similitud coseno, p. ej. 0.93.
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 5000))
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+IMAGE_MODEL = "gpt-image-1"  # ✅ Modelo actual de generación de imágenes
+IMAGE_TIMEOUT = float(os.environ.get("IMAGE_TIMEOUT", 180))
+IMAGE_FAILURE_TTL = 60  # segundos que se recuerda un prompt de imagen rechazado
+STREAM_EDIT_INTERVAL = 1.0  # segundos entre ediciones de un mensaje en streaming
 
 if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
     raise RuntimeError("Faltan variables de entorno TELEGRAM_TOKEN o OPENAI_API_KEY.")
 
+# Los updates se procesan en segundo plano para responder 200 a Telegram al instante.
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 32))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 30))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 1))
+# Límites propios para no superar los de la cuenta de OpenAI en ráfagas de mensajes.
+OPENAI_MAX_CONCURRENT = int(os.environ.get("OPENAI_MAX_CONCURRENT", 16))
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 200000))
+
+# Un único pool de conexiones keep-alive por API, dimensionado para los workers,
+# para no repetir el handshake TLS en cada llamada. El expiry por defecto de httpx
+# (5 s) cerraría la conexión precalentada antes del primer mensaje.
+http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_keepalive_connections=MAX_WORKERS,
+        max_connections=MAX_WORKERS * 2,
+        keepalive_expiry=120.0,
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+
 # ✅ Ahora se instancia un cliente OpenAI con la API key
-client = OpenAI(api_key=OPENAI_API_KEY)
-bot = telegram.Bot(token=TELEGRAM_TOKEN)
+# Limitamos timeout y reintentos para que una llamada lenta no retenga un worker indefinidamente.
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=http_client,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=OPENAI_MAX_RETRIES,
+)
+bot = telegram.Bot(
+    token=TELEGRAM_TOKEN,
+    request=Request(con_pool_size=MAX_WORKERS, connect_timeout=5, read_timeout=30),
+)
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+MAX_PENDING = int(os.environ.get("MAX_PENDING", 256))
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="update")
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+# Pool aparte para acciones de chat ("escribiendo..."), que no deben esperar en la cola de updates.
+CHAT_ACTION_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="chat-action")
+
+
+def _prewarm_connections():
+    """Abrir las conexiones TLS a OpenAI y Telegram antes del primer mensaje."""
+    try:
+        http_client.head("https://api.openai.com/v1/models", timeout=5)
+    except Exception:
+        logging.warning("No se pudo precalentar la conexión con OpenAI", exc_info=True)
+    try:
+        bot.get_me()  # usa el pool de conexiones del propio bot
+    except Exception:
+        logging.warning("No se pudo precalentar la conexión con Telegram", exc_info=True)
+
+
+threading.Thread(target=_prewarm_connections, name="prewarm", daemon=True).start()
+
+
+# --- Límite de peticiones a OpenAI ---
+class RateLimiter:
+    """Token bucket bloqueante y seguro entre hilos: `rate` unidades cada `per` segundos."""
+
+    def __init__(self, rate, per=60.0):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.fill_rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= amount:
+                        self._tokens -= amount
+                        return
+                    wait = (amount - self._tokens) / self.fill_rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Vaciar el bucket y no conceder nada durante `seconds` (p. ej. tras un 429)."""
+        with self._lock:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENT)
+_rpm_limiter = RateLimiter(OPENAI_RPM)
+_tpm_limiter = RateLimiter(OPENAI_TPM)
+
+
+def estimate_tokens(*texts):
+    """Estimación barata (~4 caracteres por token), suficiente para el limitador de TPM."""
+    return sum(len(t) for t in texts) // 4 + 1
+
+
+@contextmanager
+def openai_slot(tokens=0):
+    """Esperar turno (RPM, TPM y concurrencia) antes de llamar a OpenAI.
+
+    Si aun así OpenAI responde 429, se pausan los limitadores el tiempo que
+    indique Retry-After para que el resto de hilos no sigan insistiendo.
+    """
+    _rpm_limiter.acquire()
+    if tokens:
+        _tpm_limiter.acquire(tokens)
+    with _openai_slots:
+        try:
+            yield
+        except openai.RateLimitError as e:
+            retry_after = _retry_after(e)
+            logging.warning("Rate limit de OpenAI, pausando %.1fs", retry_after)
+            _rpm_limiter.pause(retry_after)
+            _tpm_limiter.pause(retry_after)
+            raise
+
+
+def _retry_after(error, default=1.0):
+    try:
+        return float(error.response.headers.get("retry-after", default))
+    except (AttributeError, TypeError, ValueError):
+        return default
+
+
+# --- Caché ---
+class ReplyCache:
+    """Caché clave -> texto con TTL. Usa Redis si hay REDIS_URL, si no un LRU en memoria."""
+
+    def __init__(self, maxsize=2048, redis_url=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expira_en, valor)
+        self._redis = None
+        if redis_url:
+            import redis  # solo se necesita si se configura REDIS_URL
+            self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+
+    def get(self, key):
+        value = self.peek(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Como get, pero sin contar en las estadísticas de aciertos/fallos."""
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception:
+                logging.exception("Error leyendo de Redis")
+                return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=CACHE_TTL):
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, ttl, value)
+            except Exception:
+                logging.exception("Error escribiendo en Redis")
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+reply_cache = ReplyCache(redis_url=REDIS_URL)
+
+
+class SemanticCache:
+    """Caché en memoria que devuelve la respuesta de un prompt anterior muy parecido.
+
+    Los embeddings normalizados se guardan en una matriz numpy y se comparan
+    por producto escalar (similitud coseno). Al llenarse se descarta la
+    entrada usada hace más tiempo.
+    """
+
+    def __init__(self, threshold, maxsize=SEMANTIC_CACHE_SIZE, dim=EMBEDDING_DIM):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((maxsize, dim), dtype=np.float32)
+        self._scopes = np.full(maxsize, -1, dtype=np.int32)  # id de scope por slot, -1 = libre
+        self._scope_ids = {}  # scope -> id entero
+        self._entries = OrderedDict()  # slot -> respuesta, en orden LRU
+        self._free = list(range(maxsize - 1, -1, -1))
+
+    def get(self, vector, scope):
+        with self._lock:
+            scope_id = self._scope_ids.get(scope)
+            if scope_id is None:
+                return None
+            scores = self._vectors @ vector
+            scores[self._scopes != scope_id] = -1.0
+            slot = int(scores.argmax())
+            if scores[slot] < self.threshold:
+                return None
+            self._entries.move_to_end(slot)
+            return self._entries[slot]
+
+    def set(self, vector, scope, reply):
+        with self._lock:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot, _ = self._entries.popitem(last=False)
+            self._vectors[slot] = vector
+            self._scopes[slot] = self._scope_ids.setdefault(scope, len(self._scope_ids))
+            self._entries[slot] = reply
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD) if SEMANTIC_CACHE_THRESHOLD else None
+
+
+def embed_text(text):
+    """Embedding normalizado del texto, o None si falla la llamada."""
+    try:
+        with openai_slot(estimate_tokens(text)):
+            resp = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    except Exception:
+        logging.exception("Error calculando embedding")
+        return None
+    vector = np.asarray(resp.data[0].embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def cache_key(namespace, **params):
+    """Clave determinista a partir de los parámetros de la petición."""
+    raw = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return f"{namespace}:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class PartialRelay:
+    """Entrega el último texto parcial a `callback` desde un hilo propio.
+
+    Así las llamadas a Telegram no ocupan un hueco de OpenAI mientras se lee el
+    stream; si llegan varios fragmentos durante una llamada, solo se entrega
+    el más reciente.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._latest = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="partial-relay", daemon=True)
+        self._thread.start()
+
+    def push(self, text):
+        with self._cond:
+            self._latest = text
+            self._cond.notify()
+
+    def close(self):
+        """Esperar a que se entregue el último parcial pendiente y parar el hilo."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._latest is None and not self._closed:
+                    self._cond.wait()
+                text, self._latest = self._latest, None
+            if text is None:
+                return
+            try:
+                self.callback(text)
+            except Exception:
+                logging.warning("Error entregando respuesta parcial", exc_info=True)
+
 
 # --- Helpers ---
-def chatgpt_reply(prompt, model="gpt-4o-mini", max_tokens=600):
-    """Enviar prompt a OpenAI Chat Completions y retornar texto respuesta."""
+def chatgpt_reply(prompt, model="gpt-4o-mini", max_tokens=600, temperature=0, on_partial=None):
+    """Enviar prompt a OpenAI Chat Completions y retornar texto respuesta.
+
+    Con temperature=0 la respuesta es (casi) determinista y se guarda en caché;
+    si está activada la caché semántica, también se reutilizan respuestas a
+    prompts casi idénticos.
+    Si se pasa on_partial, la respuesta se pide en streaming y se llama a
+    on_partial(texto_acumulado) desde otro hilo a medida que llegan fragmentos;
+    todas esas llamadas terminan antes de que chatgpt_reply retorne.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    key = None
+    if temperature == 0:
+        key = cache_key("chat", model=model, messages=messages,
+                        max_tokens=max_tokens, temperature=temperature)
+        cached = reply_cache.get(key)
+        if cached is not None:
+            return cached
+    vector = scope = None
+    if key and semantic_cache is not None:
+        scope = cache_key("scope", model=model, max_tokens=max_tokens)
+        vector = embed_text(prompt)
+        if vector is not None:
+            cached = semantic_cache.get(vector, scope)
+            if cached is not None:
+                reply_cache.set(key, cached)
+                return cached
+    relay = PartialRelay(on_partial) if on_partial is not None else None
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            temperature=0.7,
-        )
-        text = resp.choices[0].message.content.strip()
+        with openai_slot(estimate_tokens(prompt) + max_tokens):
+            resp = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=relay is not None,
+            )
+            if relay is None:
+                text = resp.choices[0].message.content.strip()
+            else:
+                parts = []
+                for chunk in resp:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        relay.push("".join(parts))
+                text = "".join(parts).strip()
+        if key:
+            reply_cache.set(key, text)
+        if vector is not None:
+            semantic_cache.set(vector, scope, text)
         return text
     except Exception as e:
         logging.exception("Error llamando a OpenAI ChatCompletion")
         return "Lo siento, ocurrió un error al procesar la respuesta."
+    finally:
+        if relay is not None:
+            relay.close()
+
+
+IMAGE_REJECTED = object()  # generate_image: OpenAI rechazó el prompt
+# Códigos de error 400 que indican un rechazo del prompt por moderación.
+IMAGE_POLICY_ERROR_CODES = {"content_policy_violation", "moderation_blocked"}
+
+
+def _image_failure_key(prompt, size):
+    return cache_key("image-fail", model=IMAGE_MODEL, prompt=prompt, size=size)
+
+
+def image_recently_rejected(prompt, size="1024x1024"):
+    """True si OpenAI rechazó este mismo prompt hace menos de IMAGE_FAILURE_TTL segundos."""
+    return reply_cache.peek(_image_failure_key(prompt, size)) is not None
 
 
 def generate_image(prompt, size="1024x1024"):
-    """Generar imagen con DALL·E usando la API moderna."""
+    """Generar imagen con la API moderna y devolver sus bytes (PNG).
+
+    Devuelve IMAGE_REJECTED si la moderación de OpenAI rechaza el prompt; el
+    rechazo se recuerda IMAGE_FAILURE_TTL segundos para que el llamador pueda
+    evitar reintentos idénticos con image_recently_rejected(). Ante cualquier
+    otro error devuelve None.
+    """
     try:
-        img_resp = client.images.generate(
-            model="gpt-image-1",  # ✅ Modelo actual de generación de imágenes
-            prompt=prompt,
-            size=size,
-            n=1
-        )
-        # ✅ Ahora la respuesta trae una lista con URLs o base64
-        url = img_resp.data[0].url or img_resp.data[0].b64_json
-        return url
+        with openai_slot():
+            # gpt-image-1 puede tardar hasta ~2 min; un reintento sería otra generación facturada.
+            img_resp = client.with_options(timeout=IMAGE_TIMEOUT, max_retries=0).images.generate(
+                model=IMAGE_MODEL,
+                prompt=prompt,
+                size=size,
+                n=1
+            )
+        # gpt-image-1 siempre devuelve base64; la URL solo aparece con modelos DALL·E
+        data = img_resp.data[0]
+        if data.b64_json:
+            return base64.b64decode(data.b64_json)
+        # Descargamos nosotros la imagen por el pool compartido en vez de
+        # que Telegram tenga que ir a buscarla al CDN de OpenAI.
+        resp = http_client.get(data.url)
+        resp.raise_for_status()
+        return resp.content
+    except openai.BadRequestError as e:
+        if e.code not in IMAGE_POLICY_ERROR_CODES:
+            # Otros 400 (parámetros, límite de facturación...) no dependen del prompt.
+            logging.exception("Error generando imagen")
+            return None
+        logging.warning("OpenAI rechazó el prompt de imagen: %s", e)
+        reply_cache.set(_image_failure_key(prompt, size), "1", ttl=IMAGE_FAILURE_TTL)
+        return IMAGE_REJECTED
     except Exception:
         logging.exception("Error generando imagen")
         return None
 
 
-def text_to_speech_save(text, lang="es"):
-    """Genera un mp3 con gTTS y devuelve la ruta del archivo temporal."""
+def text_to_speech_buffer(text, lang="es"):
+    """Genera un mp3 con gTTS en memoria y lo devuelve como BytesIO listo para enviar.
+
+    El audio se guarda además en la caché de disco, direccionada por
+    sha256(lang + texto), para no volver a llamar a gTTS con el mismo texto.
+    """
+    key = hashlib.sha256(f"{lang}\x00{text}".encode("utf-8")).hexdigest()
+    path = os.path.join(TTS_CACHE_DIR, key + ".mp3")
     try:
-        tts = gTTS(text=text, lang=lang)
-        fd, path = tempfile.mkstemp(suffix=".mp3")
-        os.close(fd)
-        tts.save(path)
-        return path
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        data = None
+    if data is not None:
+        try:
+            os.utime(path)  # marca de uso reciente para el barrido LRU
+        except OSError:
+            pass
+    else:
+        try:
+            tts = gTTS(text=text, lang=lang)
+            fp = io.BytesIO()
+            tts.write_to_fp(fp)
+            data = fp.getvalue()
+        except Exception:
+            logging.exception("Error TTS")
+            return None
+        _store_tts_cache(path, data)
+    buf = io.BytesIO(data)
+    buf.name = "voz.mp3"
+    return buf
+
+
+def _store_tts_cache(path, data):
+    """Guardar el mp3 en la caché de forma atómica (tempfile + os.replace)."""
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".part", dir=TTS_CACHE_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
     except Exception:
-        logging.exception("Error TTS")
-        return None
+        logging.exception("Error guardando audio en caché")
+        return
+    _sweep_tts_cache()
+
+
+def _sweep_tts_cache():
+    """Borrar los mp3 menos usados si la caché supera TTS_CACHE_MAX_FILES."""
+    try:
+        entries = [e for e in os.scandir(TTS_CACHE_DIR) if e.name.endswith(".mp3")]
+        if len(entries) <= TTS_CACHE_MAX_FILES:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - TTS_CACHE_MAX_FILES]:
+            os.unlink(entry.path)
+    except OSError:
+        logging.exception("Error limpiando la caché de audio")
+
+
+HELP_TEXT = (
+    "Hola! Soy tu bot IA.\n\n"
+    "Comandos:\n"
+    "/start /help - Mostrar ayuda\n"
+    "/imagen <texto> - Generar imagen con IA\n"
+    "/voz <texto> - Generar audio (mp3) con TTS\n\n"
+    "Si escribes cualquier otra cosa, responderé usando ChatGPT."
+)
+_help_message_id = None
+_help_post_failed = False  # LOG_CHAT_ID no es utilizable: se envía la ayuda directamente
+_help_lock = threading.Lock()
+
+
+def _log_chat_help_id():
+    """message_id de la ayuda publicada en LOG_CHAT_ID, publicándola si hace falta."""
+    global _help_message_id, _help_post_failed
+    with _help_lock:
+        if _help_message_id is None and not _help_post_failed:
+            try:
+                _help_message_id = bot.send_message(chat_id=LOG_CHAT_ID, text=HELP_TEXT).message_id
+            except (telegram.error.BadRequest, telegram.error.Unauthorized):
+                # Error permanente (chat inexistente, bot expulsado...): no se vuelve a intentar.
+                _help_post_failed = True
+                logging.warning("No se pudo publicar la ayuda en LOG_CHAT_ID; se enviará directamente",
+                                exc_info=True)
+            except telegram.error.TelegramError:
+                # Timeout, flood control, red...: se reintentará en otro /help.
+                logging.warning("Error temporal publicando la ayuda en LOG_CHAT_ID", exc_info=True)
+        return _help_message_id
+
+
+def send_help(chat_id):
+    """Enviar la ayuda. Con LOG_CHAT_ID se publica una vez allí y luego se copia con copyMessage."""
+    global _help_message_id
+    message_id = _log_chat_help_id() if LOG_CHAT_ID and not _help_post_failed else None
+    if message_id is not None:
+        try:
+            bot.copy_message(chat_id=chat_id, from_chat_id=LOG_CHAT_ID, message_id=message_id)
+            return
+        except telegram.error.BadRequest as e:
+            logging.warning("No se pudo copiar el mensaje de ayuda", exc_info=True)
+            if "message to copy not found" in str(e).lower():
+                # El mensaje se borró del chat de log: la próxima vez se vuelve a publicar.
+                with _help_lock:
+                    if _help_message_id == message_id:
+                        _help_message_id = None
+        except telegram.error.TelegramError:
+            # Timeout, flood control, usuario que bloqueó al bot...: el mensaje sigue siendo válido.
+            logging.warning("No se pudo copiar el mensaje de ayuda", exc_info=True)
+    bot.send_message(chat_id=chat_id, text=HELP_TEXT)
+
+
+class MessageStreamer:
+    """Muestra una respuesta en streaming: envía el primer fragmento y luego edita ese mensaje.
+
+    Telegram limita editMessageText a ~1 por segundo y chat, así que las
+    ediciones intermedias se espacian al menos STREAM_EDIT_INTERVAL segundos.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = None
+        self.last_text = ""
+        self.last_edit = 0.0
+
+    def update(self, text, final=False):
+        text = text.strip()
+        if not text or text == self.last_text:
+            return
+        now = time.monotonic()
+        if not final and now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        try:
+            if self.message_id is None:
+                self.message_id = bot.send_message(chat_id=self.chat_id, text=text).message_id
+            else:
+                bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+        except telegram.error.TelegramError:
+            if final:
+                raise
+            logging.warning("No se pudo actualizar el mensaje en streaming", exc_info=True)
+            return
+        self.last_text = text
+        self.last_edit = now
 
 
 # --- Rutas ---
@@ -75,11 +616,19 @@ def index():
     return "Bot Telegram - Webhook activo."
 
 
+@app.route("/stats/<secret>", methods=["GET"])
+def stats(secret):
+    """Aciertos y fallos de la caché de respuestas de ChatGPT (protegido con WEBHOOK_SECRET)."""
+    if not WEBHOOK_SECRET or secret != WEBHOOK_SECRET:
+        abort(403)
+    return reply_cache.stats()
+
+
 @app.route(f"/webhook", methods=["POST"])
 def webhook_no_secret():
     if WEBHOOK_SECRET:
         abort(404)
-    return handle_update(request.get_json(force=True))
+    return enqueue_update(read_update())
 
 
 @app.route(f"/webhook/<secret>", methods=["POST"])
@@ -87,82 +636,131 @@ def webhook_with_secret(secret):
     if not WEBHOOK_SECRET or secret != WEBHOOK_SECRET:
         logging.warning("Webhook recibido con secreto inválido.")
         abort(403)
-    return handle_update(request.get_json(force=True))
+    return enqueue_update(read_update())
 
 
-def handle_update(update_json):
+def read_update():
+    """Decodificar el cuerpo del webhook con orjson (más rápido que json de la stdlib)."""
     try:
-        update = telegram.Update.de_json(update_json, bot)
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        logging.warning("Webhook con JSON inválido.")
+        abort(400)
+
+
+def enqueue_update(update_json):
+    """Encolar el update para un worker y responder a Telegram sin esperar."""
+    if not _pending.acquire(blocking=False):
+        logging.warning("Cola de updates llena (%s), se descarta el update.", MAX_PENDING)
+        return "OK", 200
+    try:
+        future = EXECUTOR.submit(_run_update, update_json)
+    except RuntimeError:
+        _pending.release()
+        logging.exception("No se pudo encolar el update")
+        return "OK", 200
+    future.add_done_callback(lambda _: _pending.release())
+    return "OK", 200
+
+
+def _run_update(update_json):
+    try:
+        handle_update(update_json)
     except Exception:
-        logging.exception("JSON inválido para telegram.Update")
-        return "OK"
+        logging.exception("Error procesando update")
 
-    message = update.message
-    if not message:
-        return "OK"
 
-    chat_id = message.chat.id
-    text = message.text or ""
-    user = message.from_user.username if message.from_user else str(message.from_user)
+def _log_future_error(future):
+    exc = future.exception()
+    if exc is not None:
+        logging.warning("Error en tarea en segundo plano: %s", exc)
 
-    logging.info("Mensaje de %s en chat %s: %s", user, chat_id, text)
 
-    if text.startswith("/start") or text.startswith("/help"):
-        help_text = (
-            "Hola! Soy tu bot IA.\n\n"
-            "Comandos:\n"
-            "/start /help - Mostrar ayuda\n"
-            "/imagen <texto> - Generar imagen con IA\n"
-            "/voz <texto> - Generar audio (mp3) con TTS\n\n"
-            "Si escribes cualquier otra cosa, responderé usando ChatGPT."
-        )
-        bot.send_message(chat_id=chat_id, text=help_text)
+# --- Comandos ---
+def cmd_help(chat_id, arg):
+    send_help(chat_id)
+
+
+IMAGE_REJECTED_TEXT = "OpenAI rechazó esa descripción de imagen. Prueba a reformularla."
+
+
+def cmd_image(chat_id, prompt):
+    if not prompt:
+        bot.send_message(chat_id=chat_id, text="Usa: /imagen <descripción de la imagen>")
+        return
+    if image_recently_rejected(prompt):
+        bot.send_message(chat_id=chat_id, text=IMAGE_REJECTED_TEXT)
+        return
+    bot.send_message(chat_id=chat_id, text="Generando imagen... ⏳")
+    image = generate_image(prompt)
+    if image is IMAGE_REJECTED:
+        bot.send_message(chat_id=chat_id, text=IMAGE_REJECTED_TEXT)
+        return
+    if not image:
+        bot.send_message(chat_id=chat_id, text="No pude generar la imagen. Intenta de nuevo más tarde.")
+        return
+
+    photo = io.BytesIO(image)
+    photo.name = "imagen.png"
+    bot.send_photo(chat_id=chat_id, photo=photo, caption=f"Imagen: {prompt}")
+
+
+def cmd_voice(chat_id, prompt):
+    if not prompt:
+        bot.send_message(chat_id=chat_id, text="Usa: /voz <texto a convertir en audio>")
+        return
+    bot.send_message(chat_id=chat_id, text="Generando audio... ⏳")
+    audio = text_to_speech_buffer(prompt, lang="es")
+    if not audio:
+        bot.send_message(chat_id=chat_id, text="No pude generar el audio. Intenta luego.")
+        return
+    bot.send_audio(chat_id=chat_id, audio=audio, timeout=120)
+
+
+def cmd_chat(chat_id, text):
+    # El "escribiendo..." se envía en paralelo para no retrasar la llamada a OpenAI.
+    typing = CHAT_ACTION_EXECUTOR.submit(bot.send_chat_action, chat_id=chat_id, action=telegram.ChatAction.TYPING)
+    typing.add_done_callback(_log_future_error)
+    streamer = MessageStreamer(chat_id)
+    reply = chatgpt_reply(text, on_partial=streamer.update)
+    streamer.update(reply, final=True)
+
+
+COMMANDS = {
+    "/start": cmd_help,
+    "/help": cmd_help,
+    "/imagen": cmd_image,
+    "/voz": cmd_voice,
+    "/tts": cmd_voice,
+}
+
+
+def handle_update(update_json):
+    # Solo se usan tres campos, así que se leen del JSON sin construir telegram.Update.
+    if not isinstance(update_json, dict):
+        logging.warning("Update con formato inválido: %r", update_json)
         return "OK"
 
-    if text.startswith("/imagen"):
-        prompt = text.partition(" ")[2].strip()
-        if not prompt:
-            bot.send_message(chat_id=chat_id, text="Usa: /imagen <descripción de la imagen>")
-            return "OK"
-        bot.send_message(chat_id=chat_id, text="Generando imagen... ⏳")
-        url_or_b64 = generate_image(prompt)
-        if not url_or_b64:
-            bot.send_message(chat_id=chat_id, text="No pude generar la imagen. Intenta de nuevo más tarde.")
-            return "OK"
-
-        if url_or_b64.startswith("http"):
-            bot.send_photo(chat_id=chat_id, photo=url_or_b64, caption=f"Imagen: {prompt}")
-            return "OK"
-        else:
-            import base64
-            data = base64.b64decode(url_or_b64)
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-            tmp.write(data)
-            tmp.flush()
-            tmp.close()
-            with open(tmp.name, "rb") as f:
-                bot.send_photo(chat_id=chat_id, photo=f, caption=f"Imagen: {prompt}")
-            os.unlink(tmp.name)
-            return "OK"
-
-    if text.startswith("/voz") or text.startswith("/tts"):
-        prompt = text.partition(" ")[2].strip()
-        if not prompt:
-            bot.send_message(chat_id=chat_id, text="Usa: /voz <texto a convertir en audio>")
-            return "OK"
-        bot.send_message(chat_id=chat_id, text="Generando audio... ⏳")
-        path = text_to_speech_save(prompt, lang="es")
-        if not path:
-            bot.send_message(chat_id=chat_id, text="No pude generar el audio. Intenta luego.")
-            return "OK"
-        with open(path, "rb") as audio_file:
-            bot.send_audio(chat_id=chat_id, audio=audio_file, timeout=120)
-        os.unlink(path)
+    message = update_json.get("message")
+    if not message:
         return "OK"
 
-    bot.send_chat_action(chat_id=chat_id, action=telegram.ChatAction.TYPING)
-    reply = chatgpt_reply(text)
-    bot.send_message(chat_id=chat_id, text=reply)
+    try:
+        chat_id = message["chat"]["id"]
+    except (KeyError, TypeError):
+        logging.warning("Mensaje sin chat: %r", message)
+        return "OK"
+    text = message.get("text") or ""
+    user = (message.get("from") or {}).get("username") or "?"
+
+    logging.info("Mensaje de %s en chat %s: %s", user, chat_id, text)
+
+    cmd, _, arg = text.partition(" ")
+    handler = COMMANDS.get(cmd.split("@", 1)[0])  # "/imagen@MiBot" en grupos
+    if handler:
+        handler(chat_id, arg.strip())
+    else:
+        cmd_chat(chat_id, text)
     return "OK"
 
 # --- Punto de entrada para ejecutar localmente (útil en pruebas) ---
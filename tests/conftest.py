@@ -0,0 +1,23 @@
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py exige estas variables al importarse; los tests nunca llegan a la red.
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.pop("REDIS_URL", None)
+
+# Al importar, main.py arranca el hilo que precalienta conexiones; no lo queremos en tests.
+with mock.patch("threading.Thread.start"):
+    import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def stub_apis(monkeypatch):
+    """Sustituir los clientes de OpenAI y Telegram por mocks."""
+    monkeypatch.setattr(main, "client", mock.Mock())
+    monkeypatch.setattr(main, "bot", mock.Mock())
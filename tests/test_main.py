@@ -0,0 +1,134 @@
+import threading
+import time
+
+import numpy as np
+
+import main
+
+
+# --- RateLimiter ---
+def test_rate_limiter_refills_over_time():
+    limiter = main.RateLimiter(10, per=1.0)
+    for _ in range(10):
+        limiter.acquire()  # el bucket empieza lleno
+    start = time.monotonic()
+    limiter.acquire()
+    assert 0.05 <= time.monotonic() - start < 0.5
+
+
+def test_rate_limiter_pause_blocks_until_expired():
+    limiter = main.RateLimiter(1000, per=1.0)
+    limiter.pause(0.2)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.2
+
+
+# --- PartialRelay ---
+def test_partial_relay_delivers_latest_and_finishes_before_close():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def callback(text):
+        calls.append(text)
+        if text == "a":
+            started.set()
+            release.wait(1)
+
+    relay = main.PartialRelay(callback)
+    relay.push("a")
+    assert started.wait(1)
+    relay.push("b")  # se sustituye por "c" antes de entregarse
+    relay.push("c")
+    release.set()
+    relay.close()
+    assert calls == ["a", "c"]
+
+
+# --- ReplyCache ---
+def test_reply_cache_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    cache = main.ReplyCache()
+    cache.set("k", "v", ttl=10)
+    assert cache.get("k") == "v"
+    now[0] += 11
+    assert cache.get("k") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_reply_cache_evicts_least_recently_used():
+    cache = main.ReplyCache(maxsize=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert cache.peek("b") is None
+    assert cache.peek("a") == "1"
+    assert cache.peek("c") == "3"
+
+
+# --- SemanticCache ---
+def _unit(*values):
+    v = np.asarray(values, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_semantic_cache_ignores_other_scopes():
+    cache = main.SemanticCache(0.9, maxsize=4, dim=3)
+    query = _unit(1, 0, 0)
+    cache.set(query, "otro", "de otro scope")  # coincidencia exacta, pero otro scope
+    cache.set(_unit(1, 0.1, 0), "mio", "respuesta")
+    assert cache.get(query, "mio") == "respuesta"
+    assert cache.get(query, "desconocido") is None
+
+
+def test_semantic_cache_evicts_least_recently_used():
+    cache = main.SemanticCache(0.9, maxsize=2, dim=3)
+    a, b, c = _unit(1, 0, 0), _unit(0, 1, 0), _unit(0, 0, 1)
+    cache.set(a, "s", "A")
+    cache.set(b, "s", "B")
+    assert cache.get(a, "s") == "A"
+    cache.set(c, "s", "C")
+    assert cache.get(b, "s") is None
+    assert cache.get(a, "s") == "A"
+    assert cache.get(c, "s") == "C"
+
+
+# --- text_to_speech_buffer ---
+class FakeTTS:
+    calls = 0
+
+    def __init__(self, text, lang):
+        pass
+
+    def write_to_fp(self, fp):
+        FakeTTS.calls += 1
+        fp.write(b"MP3")
+
+
+def test_tts_buffer_miss_then_hit(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TTS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "gTTS", FakeTTS)
+    FakeTTS.calls = 0
+
+    assert main.text_to_speech_buffer("hola").read() == b"MP3"
+    assert len(list(tmp_path.glob("*.mp3"))) == 1
+    assert main.text_to_speech_buffer("hola").read() == b"MP3"
+    assert FakeTTS.calls == 1
+
+
+def test_tts_buffer_hit_survives_utime_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TTS_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "gTTS", FakeTTS)
+    FakeTTS.calls = 0
+    main.text_to_speech_buffer("hola")
+
+    def fail(*args, **kwargs):
+        raise OSError("borrado por el barrido")
+
+    monkeypatch.setattr(main.os, "utime", fail)
+    assert main.text_to_speech_buffer("hola").read() == b"MP3"  # sin audio duplicado
+    assert FakeTTS.calls == 1